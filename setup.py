@@ -14,6 +14,10 @@ setup(
         'sqlparse',
         'traitlets'
     ),
-    tests_require=['pytest>=3.0'],
+    extras_require={
+        'memory': ['pyarrow'],
+        'async': ['aiosqlite']
+    },
+    tests_require=['pytest>=3.0', 'pyarrow', 'aiosqlite'],
     include_package_data=True
 )
@@ -20,14 +20,21 @@ connection.py
 Logic for running SQL queries against a DB or Spark/Hive.
 """
 
+import asyncio
+import functools
+import sqlite3
 import sys
 import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 import sqlparse
 
+import pandas as pd
 import pandas.io.sql as psql
 
-from .exceptions import ConnectionNotConfigured, EmptyResult
+from .exceptions import AsyncError, ConnectionNotConfigured, EmptyResult
+from .memory import MemoryGovernor
 from .notify import Notify
 
 try:
@@ -35,16 +42,36 @@ try:
 except ImportError:
     from IPython.utils.traitlets import TraitError
 
+try:
+    from IPython.core.async_helpers import get_asyncio_loop
+except ImportError:  # IPython < 8
+    _asyncio_loop = None
+
+    def get_asyncio_loop():
+        """Return one event loop reused by every --await cell run without a running loop."""
+        global _asyncio_loop
+        if _asyncio_loop is None or _asyncio_loop.is_closed():
+            _asyncio_loop = asyncio.new_event_loop()
+        return _asyncio_loop
+
 class Connection(object):
 
-    def __init__(self, shell, available_connection_types, no_return_result_exceptions):
+    def __init__(self, shell, available_connection_types, no_return_result_exceptions,
+                 async_connection_types=()):
         """Initialize Connection object with user shell, available connection types,
-        and exceptions for when no result is returned"""
+        exceptions for when no result is returned, and connection types that can only
+        be used from the event loop"""
         self.shell = shell
         self.available_connection_types = available_connection_types
         self.no_return_result_exceptions = no_return_result_exceptions
+        self.async_connection_types = async_connection_types
         self.notify_obj = Notify(shell)
+        self.memory = MemoryGovernor(shell)
         self.caller = None
+        self.async_caller = None
+        self._tasks = set()  # keep references to running queries so they aren't garbage collected
+        self._conn_locks = weakref.WeakKeyDictionary()  # serializes queries on a single asyncpg connection
+        self._conn_executors = weakref.WeakKeyDictionary()  # one worker thread per DB API connection
 
     def _is_an_available_connection(self, connection):
         """Make sure the connection object is a valid connection type"""
@@ -56,6 +83,10 @@ class Connection(object):
             return False
         return type(connection).__module__.startswith('pyspark')
 
+    def _is_an_async_connection(self, connection):
+        """Check if connection is an async driver object (aiosqlite, asyncpg, SQLAlchemy AsyncEngine)."""
+        return isinstance(connection, tuple(self.async_connection_types))
+
     def _psql_read_sql_to_df(self, conn_object):
         """Execute SQL code using sqlalchemy engine or other
         Python DB Specification 2.0 and return result as Pandas."""
@@ -82,14 +113,125 @@ class Connection(object):
             return df
         return _run_spark_sql
 
+    def _async_only_call(self, conn_object):
+        """Caller for async driver objects used without --await."""
+        def _run_async_only_sql(sql_code):
+            raise AsyncError('Connection of type "{}" must be used with --await'
+                             .format(type(conn_object).__name__))
+        return _run_async_only_sql
+
     def _read_connection(self, conn_object):
         """Determine is connection is relational DB or Spark object and make a connection."""
         if self._is_a_spark_connection(conn_object):
             caller = self._spark_call(conn_object)
+        elif self._is_an_async_connection(conn_object):
+            caller = self._async_only_call(conn_object)
         else:
             caller = self._psql_read_sql_to_df(conn_object)
         return caller
 
+    def _aiosqlite_call(self, conn_object):
+        """Execute SQL code using an aiosqlite connection and return result as Pandas."""
+        async def _run_aiosqlite_sql(sql_code):
+            async with conn_object.execute(sql_code) as cursor:
+                if cursor.description is None:  # statement returned no rows (e.g. CREATE)
+                    await conn_object.commit()
+                    return EmptyResult()
+                rows = await cursor.fetchall()
+                return pd.DataFrame(rows, columns=[d[0] for d in cursor.description])
+        return _run_aiosqlite_sql
+
+    def _asyncpg_call(self, conn_object):
+        """Execute SQL code using an asyncpg connection or pool and return result as Pandas."""
+        async def _fetch(conn, sql_code):
+            stmt = await conn.prepare(sql_code)
+            columns = [a.name for a in stmt.get_attributes()]
+            records = await stmt.fetch()
+            if not columns:  # statement returned no rows (e.g. CREATE)
+                return EmptyResult()
+            return pd.DataFrame([tuple(r) for r in records], columns=columns)
+
+        async def _run_asyncpg_sql(sql_code):
+            if hasattr(conn_object, 'acquire'):  # asyncpg.Pool
+                async with conn_object.acquire() as conn:
+                    return await _fetch(conn, sql_code)
+            # a single connection runs one operation at a time; queue concurrent queries
+            if conn_object not in self._conn_locks:
+                self._conn_locks[conn_object] = asyncio.Lock()
+            async with self._conn_locks[conn_object]:
+                return await _fetch(conn_object, sql_code)
+        return _run_asyncpg_sql
+
+    def _sqlalchemy_async_call(self, conn_object):
+        """Execute SQL code using a SQLAlchemy AsyncEngine and return result as Pandas."""
+        def _run_sync(sync_conn, sql_code):
+            try:
+                return psql.read_sql(sql_code, sync_conn)
+            except(tuple(self.no_return_result_exceptions)):
+                return EmptyResult()
+
+        async def _run_sqlalchemy_async_sql(sql_code):
+            async with conn_object.begin() as conn:
+                return await conn.run_sync(_run_sync, sql_code)
+        return _run_sqlalchemy_async_sql
+
+    def _sqlite3_call(self, conn_object):
+        """Run a sqlite3 caller on the event loop thread; sqlite3 connections can only be
+        used from the thread that created them (unless check_same_thread=False)."""
+        caller = self._read_connection(conn_object)
+
+        async def _run_sqlite3_sql(sql_code):
+            try:
+                return caller(sql_code)
+            except sqlite3.ProgrammingError as e:
+                if 'thread' not in str(e):
+                    raise
+                raise AsyncError('sqlite3 connection was created in another thread; create it with '
+                                 'check_same_thread=False or use aiosqlite') from e
+        return _run_sqlite3_sql
+
+    def _get_conn_executor(self, conn_object):
+        """Return a single worker executor for a DB API connection so its queries run one
+        at a time, in the same thread."""
+        try:
+            if conn_object not in self._conn_executors:
+                self._conn_executors[conn_object] = ThreadPoolExecutor(max_workers=1)
+            return self._conn_executors[conn_object]
+        except TypeError:  # connection type doesn't support weak references
+            return None
+
+    def _executor_call(self, conn_object):
+        """Run a blocking caller in an executor so it can be awaited. SQLAlchemy engines
+        and Spark are thread safe and use the default executor; other DB API connections
+        get their own single worker executor."""
+        caller = self._read_connection(conn_object)
+        if self._is_a_spark_connection(conn_object) or type(conn_object).__module__.startswith('sqlalchemy'):
+            executor = None
+        else:
+            executor = self._get_conn_executor(conn_object) or ThreadPoolExecutor(max_workers=1)
+
+        async def _run_executor_sql(sql_code):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, caller, sql_code)
+        return _run_executor_sql
+
+    def _read_connection_async(self, conn_object):
+        """Determine which async driver the connection uses and return a coroutine caller.
+        Blocking connections (DB API 2.0, SQLAlchemy Engine, Spark) are run in an executor,
+        except sqlite3 connections which are run on the event loop thread."""
+        module = type(conn_object).__module__
+        if isinstance(conn_object, sqlite3.Connection):
+            caller = self._sqlite3_call(conn_object)
+        elif not self._is_an_async_connection(conn_object):
+            caller = self._executor_call(conn_object)
+        elif module.startswith('aiosqlite'):
+            caller = self._aiosqlite_call(conn_object)
+        elif module.startswith('asyncpg'):
+            caller = self._asyncpg_call(conn_object)
+        else:  # sqlalchemy.ext.asyncio.AsyncEngine
+            caller = self._sqlalchemy_async_call(conn_object)
+        return caller
+
     def _validate_conn_object(self, conn_name, shell):
         """Check if user-supplied connection string is in the namespace."""
         try:
@@ -99,44 +241,82 @@ class Connection(object):
             raise TraitError('Connection name "{}" not recognized'.format(conn_name))
         return conn_name
 
-    def _read_sql_engine(self, sql, options):
-        """Runs SQL query and uses options if use wants to force the SQL caller,
-        return the result as a variable, and show a browser notification"""
-        option_keys = ['table_name', 'display', 'notify', 'force_caller', '_async']
-        table_name, show_output, notify_result, force_caller, _async = [options[k] for k in option_keys]
-        if table_name:  # for async
-            self.shell.user_global_ns.update({table_name: 'QUERY RUNNING'})
-
+    def _get_caller(self, force_caller, _await=False):
+        """Return the caller for the forced connection object or the configured one.
+        If _await, return a coroutine caller."""
         if force_caller:
             self._validate_conn_object(force_caller, self.shell)
             force_caller_obj = self.shell.user_global_ns[force_caller]
-            caller = self._read_connection(force_caller_obj)
+            if _await:
+                caller = self._read_connection_async(force_caller_obj)
+            else:
+                caller = self._read_connection(force_caller_obj)
         else:
-            caller = self.caller
+            caller = self.async_caller if _await else self.caller
         if caller is None:
             raise ConnectionNotConfigured("A connection object must be configured using %config SQL.conn_name")
-        result, del_time, time_output = self._time_and_run_query(caller, sql)
+        return caller
 
+    def _store_result(self, result, del_time, time_output, options):
+        """Assign result to the user variable and show a browser notification."""
+        table_name, notify_result = options['table_name'], options['notify']
         if table_name:
             # assign result to variable
             self.shell.user_global_ns.update({table_name: result})
+            self.memory.track(table_name, result)
         if notify_result:
             self.notify_obj.notify_complete(del_time, table_name, result.shape)
             sys.stdout.write(time_output)
+
+    def _read_sql_engine(self, sql, options):
+        """Runs SQL query and uses options if use wants to force the SQL caller,
+        return the result as a variable, and show a browser notification"""
+        table_name, force_caller = options['table_name'], options['force_caller']
+        if table_name:  # for async
+            self.shell.user_global_ns.update({table_name: 'QUERY RUNNING'})
+        caller = self._get_caller(force_caller)
+        result, del_time, time_output = self._time_and_run_query(caller, sql)
+        self._store_result(result, del_time, time_output, options)
         return result
 
-    def _time_and_run_query(self, caller, sql):
-        """Time the query and execute the SQL using the caller."""
+    async def _read_sql_engine_async(self, sql, options):
+        """Awaitable version of _read_sql_engine; runs the query on the event loop."""
+        table_name, force_caller = options['table_name'], options['force_caller']
+        if table_name:
+            self.shell.user_global_ns.update({table_name: 'QUERY RUNNING'})
+        caller = self._get_caller(force_caller, _await=True)
+        result, del_time, time_output = await self._time_and_run_query_async(caller, sql)
+        self._store_result(result, del_time, time_output, options)
+        return result
+
+    def _start_query(self):
+        """Write and return the query start message and start time."""
         pretty_start_time = time.strftime('%I:%M:%S %p %Z')
         time_output = 'Query started at {}'.format(pretty_start_time)
         sys.stdout.write(time_output)
-        start_time = time.time()
-        result = caller(sql)
+        return time_output, time.time()
+
+    def _finish_query(self, time_output, start_time):
+        """Write the query execution time and return it with the full time message."""
         end_time = time.time()
         del_time = (end_time - start_time) / 60.
         query_finish_str = '; Query executed in {:2.2f} m'.format(del_time)
         sys.stdout.write(query_finish_str)
         time_output += query_finish_str  # need to save this bc clearing output for notifications
+        return del_time, time_output
+
+    def _time_and_run_query(self, caller, sql):
+        """Time the query and execute the SQL using the caller."""
+        time_output, start_time = self._start_query()
+        result = caller(sql)
+        del_time, time_output = self._finish_query(time_output, start_time)
+        return result, del_time, time_output
+
+    async def _time_and_run_query_async(self, caller, sql):
+        """Time the query and await the SQL using the coroutine caller."""
+        time_output, start_time = self._start_query()
+        result = await caller(sql)
+        del_time, time_output = self._finish_query(time_output, start_time)
         return result, del_time, time_output
 
     def execute_sqls(self, sqls, options):
@@ -145,3 +325,46 @@ class Connection(object):
         for i, s in enumerate(sqls, start=1):
             r = self._read_sql_engine(s, options)
         return r  # return last result
+
+    async def execute_sqls_async(self, sqls, options):
+        """Await a list of sql statements in order"""
+        r = None
+        for s in sqls:
+            r = await self._read_sql_engine_async(s, options)
+        return r  # return last result
+
+    def schedule_sqls_async(self, sqls, options):
+        """Run a list of sql statements as a task on the running event loop (e.g. the
+        Jupyter kernel's loop). If no loop is running, run the statements to completion."""
+        if options['table_name']:  # assigned before the task gets a chance to run
+            self.shell.user_global_ns.update({options['table_name']: 'QUERY RUNNING'})
+        coro = self.execute_sqls_async(sqls, options)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            try:
+                return get_asyncio_loop().run_until_complete(coro)
+            except BaseException:
+                self._clear_placeholder(options['table_name'])
+                raise
+        task = loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(functools.partial(self._task_done, table_name=options['table_name']))
+        return task
+
+    def _clear_placeholder(self, table_name):
+        """Remove the 'QUERY RUNNING' placeholder of a query that didn't finish."""
+        value = self.shell.user_global_ns.get(table_name)
+        if table_name and isinstance(value, str) and value == 'QUERY RUNNING':
+            del self.shell.user_global_ns[table_name]
+
+    def _task_done(self, task, table_name=None):
+        """Report the error of a failed query task; nothing awaits it."""
+        self._tasks.discard(task)
+        if task.cancelled():
+            self._clear_placeholder(table_name)
+            return
+        exc = task.exception()
+        if exc is not None:
+            self._clear_placeholder(table_name)
+            self.shell.showtraceback((type(exc), exc, exc.__traceback__))
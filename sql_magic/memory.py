@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2017-Present Pivotal Software, Inc. All rights reserved.
+#
+# This program and the accompanying materials are made available under
+# the terms of the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+memory.py
+~~~~~~~~~~~~~~~~~~~~~
+
+Track query results bound in the user namespace and spill the least recently
+used ones to disk when they exceed a memory budget.
+"""
+
+import ast
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import weakref
+
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+
+def _remove_spill_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _read_spill_file(path):
+    """Read a spill file back as a regular in-memory DataFrame. The file is memory-mapped
+    only so Arrow doesn't hold a second copy while converting; zero-copy columns would be
+    read-only and break in-place edits."""
+    table = feather.read_table(path, memory_map=True)
+    return table.to_pandas(self_destruct=True)
+
+
+def _loaded_names(shell, raw_cell):
+    """Names the cell reads. Names that are deleted or assigned, and names in strings
+    (comments, magic arguments such as a %%read_sql target), are left out."""
+    transform_cell = getattr(shell, 'transform_cell', None)  # IPython 7+
+    code = transform_cell(raw_cell) if transform_cell else raw_cell
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return set()
+    return set(node.id for node in ast.walk(tree)
+               if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load))
+
+
+class SpilledResult(object):
+    """Placeholder left in the namespace for a result spilled to disk.
+    Any attribute access or operator reloads the DataFrame and rebinds it to its name.
+    Names referenced in a cell are reloaded before it runs, so isinstance checks and
+    pandas functions see the DataFrame itself."""
+
+    def __init__(self, governor, name, path, shape, size):
+        self._governor = governor
+        self._name = name
+        self._path = path
+        self._df = None  # DataFrame once reloaded, so copies of the proxy keep working
+        self.shape = shape
+        self._size = size
+        # the file is only deleted once nothing can reload from it
+        weakref.finalize(self, _remove_spill_file, path)
+
+    def load(self):
+        """Reload the DataFrame from disk."""
+        if self._df is None:
+            self._governor.load(self._name, self)
+        return self._df
+
+    def __getattr__(self, attr):
+        if attr in ('_governor', '_name', '_path', '_df'):  # not yet initialized (e.g. unpickling)
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+
+    def __len__(self):
+        return len(self.load())
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __contains__(self, item):
+        return item in self.load()
+
+    def __array__(self, *args, **kwargs):
+        return self.load().__array__(*args, **kwargs)
+
+    def __repr__(self):
+        return repr(self.load())
+
+    def _repr_html_(self):
+        return self.load()._repr_html_()
+
+
+def _forward(op):
+    def method(self, *args):
+        return getattr(self.load(), op)(*args)
+    method.__name__ = op
+    return method
+
+# operators are looked up on the type, so __getattr__ doesn't see them
+for _op in ('add', 'sub', 'mul', 'truediv', 'floordiv', 'mod', 'pow', 'and', 'or', 'xor'):
+    setattr(SpilledResult, '__{}__'.format(_op), _forward('__{}__'.format(_op)))
+    setattr(SpilledResult, '__r{}__'.format(_op), _forward('__r{}__'.format(_op)))
+for _op in ('eq', 'ne', 'lt', 'le', 'gt', 'ge', 'neg', 'pos', 'abs', 'invert'):
+    setattr(SpilledResult, '__{}__'.format(_op), _forward('__{}__'.format(_op)))
+
+
+class _Entry(object):
+
+    def __init__(self, df):
+        self.ref = weakref.ref(df)  # don't keep results alive after the user drops them
+        self.size = int(df.memory_usage(deep=True).sum())
+        self.shape = df.shape
+        self.last_access = time.time()
+        self.proxy = None  # SpilledResult once on disk
+
+
+class MemoryGovernor(object):
+
+    def __init__(self, shell):
+        self.shell = shell
+        self.budget = 0  # bytes; 0 disables spilling
+        self.spill_dir = ''
+        self._tmp_dir = None
+        self._entries = {}
+        self._lock = threading.RLock()  # results can be bound from -a threads
+        atexit.register(self.cleanup)
+
+    def _is_bound(self, name, entry):
+        """Check the name still refers to the tracked result."""
+        value = self.shell.user_global_ns.get(name)
+        if entry.proxy is not None:
+            return value is entry.proxy
+        return value is not None and value is entry.ref()
+
+    def _prune(self):
+        """Forget results that were deleted or rebound by the user."""
+        for name, entry in list(self._entries.items()):
+            if not self._is_bound(name, entry):
+                self._forget(name)
+
+    def _forget(self, name):
+        # spill files are removed by the proxy's finalizer, not here: aliases,
+        # containers or the output cache may still hold the proxy
+        self._entries.pop(name, None)
+
+    def _get_spill_dir(self):
+        if self.spill_dir:
+            if not os.path.isdir(self.spill_dir):
+                os.makedirs(self.spill_dir)
+            return self.spill_dir
+        if self._tmp_dir is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix='sql_magic_')
+        return self._tmp_dir
+
+    def in_memory_size(self):
+        """Total size in bytes of tracked results that are held in memory."""
+        with self._lock:
+            self._prune()
+            return sum(e.size for e in self._entries.values() if e.proxy is None)
+
+    def track(self, name, result):
+        """Record a result bound to name in the user namespace and enforce the budget."""
+        if not isinstance(result, pd.DataFrame):
+            return
+        with self._lock:
+            self._forget(name)
+            self._entries[name] = _Entry(result)
+            self.enforce_budget(exclude=(name,))
+
+    def touch(self, names):
+        """Update last access time of tracked results."""
+        now = time.time()
+        with self._lock:
+            for name in names:
+                if name in self._entries:
+                    self._entries[name].last_access = now
+
+    def pre_run_cell(self, info=None):
+        """IPython event: mark results referenced in the cell as recently used and
+        reload the ones that were spilled."""
+        raw_cell = getattr(info, 'raw_cell', None) or ''
+        with self._lock:
+            names = _loaded_names(self.shell, raw_cell) & set(self._entries)
+            self.touch(names)
+            for name in names:
+                self.load(name, exclude=names)
+
+    def enforce_budget(self, exclude=()):
+        """Spill least recently used results until in-memory results fit the budget."""
+        if not self.budget:
+            return
+        with self._lock:
+            total = self.in_memory_size()
+            candidates = sorted((e.last_access, name) for name, e in self._entries.items()
+                                if e.proxy is None and name not in exclude)
+            for _, name in candidates:
+                if total <= self.budget:
+                    break
+                size = self._entries[name].size
+                if self.spill(name):
+                    total -= size
+
+    def spill(self, name):
+        """Write a result to an Arrow file and replace it in the namespace with a SpilledResult.
+        Returns True if the result was spilled."""
+        if feather is None:
+            sys.stderr.write('pyarrow must be installed to spill results to disk\n')
+            return False
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.proxy is not None or not self._is_bound(name, entry):
+                return False
+            df = entry.ref()
+            # unique per spill: older files may still be needed by proxies held in aliases
+            fd, path = tempfile.mkstemp(prefix='{}_'.format(name), suffix='.arrow', dir=self._get_spill_dir())
+            os.close(fd)
+            try:
+                # uncompressed so the file can be memory-mapped when read back
+                feather.write_feather(df, path, compression='uncompressed')
+            except Exception as e:  # e.g. duplicate column names, objects Arrow can't serialize
+                _remove_spill_file(path)
+                sys.stderr.write('Could not spill "{}" to disk: {}\n'.format(name, e))
+                return False
+            proxy = SpilledResult(self, name, path, entry.shape, entry.size)
+            self._replace_references(df, proxy)
+            entry.proxy = proxy
+            return True
+
+    def _replace_references(self, old, new):
+        """Rebind every namespace and output cache reference to old so it can be freed."""
+        ns = self.shell.user_global_ns
+        for k, v in list(ns.items()):
+            if v is old:
+                ns[k] = new
+        out = ns.get('Out')
+        if isinstance(out, dict):
+            for k, v in list(out.items()):
+                if v is old:
+                    out[k] = new
+
+    def load(self, name, proxy=None, exclude=()):
+        """Reload a spilled result from disk and rebind it to its name. Results named
+        in exclude are kept in memory when enforcing the budget afterwards."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if proxy is None:
+                if entry is None or entry.proxy is None:
+                    return self.shell.user_global_ns.get(name)
+                proxy = entry.proxy
+            if proxy._df is not None:
+                return proxy._df
+            df = _read_spill_file(proxy._path)
+            proxy._df = df
+            self._replace_references(proxy, df)
+            if entry is not None and entry.proxy is proxy:
+                self._entries[name] = _Entry(df)
+                self.enforce_budget(exclude=set(exclude) | {name})
+            # otherwise the name was rebound or deleted; only the proxy's holders see df
+            return df
+
+    def report(self):
+        """Return a DataFrame describing the tracked results."""
+        with self._lock:
+            self._prune()
+            rows = [{'name': name,
+                     'shape': e.shape,
+                     'size_mb': e.size / 2. ** 20,
+                     'last_access': time.strftime('%I:%M:%S %p %Z', time.localtime(e.last_access)),
+                     'status': 'memory' if e.proxy is None else 'spilled',
+                     'path': '' if e.proxy is None else e.proxy._path}
+                    for name, e in sorted(self._entries.items(), key=lambda item: -item[1].last_access)]
+        return pd.DataFrame(rows, columns=['name', 'shape', 'size_mb', 'last_access', 'status', 'path'])
+
+    def cleanup(self):
+        """Delete spill files created by the governor."""
+        with self._lock:
+            self._entries.clear()
+            if self._tmp_dir is not None:
+                shutil.rmtree(self._tmp_dir, ignore_errors=True)
+                self._tmp_dir = None
+
+    def close(self):
+        """Delete spill files and stop tracking; called when the extension is unloaded.
+        Results still spilled at this point can no longer be reloaded."""
+        self.cleanup()
+        atexit.unregister(self.cleanup)
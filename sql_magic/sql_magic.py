@@ -20,26 +20,30 @@ sql_magic.py
 Magic functions for using Jupyter Notebook with Apache Spark/Hive and a variety of SQL databases.
 """
 
+import asyncio
 import threading
 
 import sqlparse
-from IPython.core.magic import Magics, magics_class, line_cell_magic, cell_magic, needs_local_scope
+from IPython.core.magic import Magics, magics_class, line_magic, line_cell_magic, cell_magic, needs_local_scope
+
+from IPython.core.error import UsageError
 
 from .connection import Connection
 from . import utils
 
 try:
     from traitlets.config.configurable import Configurable
-    from traitlets import observe, validate, Bool, Unicode, TraitError
+    from traitlets import observe, validate, Bool, Float, Unicode, TraitError
 except ImportError:
     from IPython.config.configurable import Configurable
-    from IPython.utils.traitlets import observe, validate, Bool, Unicode, TraitError
+    from IPython.utils.traitlets import observe, validate, Bool, Float, Unicode, TraitError
 
 
 # see what modules are installed
 # for each installed module, record connection types
 # and exception names
 available_connection_types = []
+async_connection_types = []  # only usable from the event loop with --await
 no_return_result_exceptions = []  # catch exception if user used read_sql where query returns no result
 try:
     import pyspark
@@ -65,6 +69,23 @@ try:
     no_return_result_exceptions.append(sqlalchemy.exc.ResourceClosedError)
 except ImportError:
     pass
+try:
+    from sqlalchemy.ext.asyncio import AsyncEngine  # sqlalchemy 1.4+
+    async_connection_types.append(AsyncEngine)
+except ImportError:
+    pass
+try:
+    import aiosqlite
+    async_connection_types.append(aiosqlite.Connection)
+except ImportError:
+    pass
+try:
+    import asyncpg
+    async_connection_types.append(asyncpg.connection.Connection)
+    async_connection_types.append(asyncpg.pool.Pool)
+except ImportError:
+    pass
+available_connection_types.extend(async_connection_types)
 
 
 DEFAULT_OUTPUT_RESULT = True
@@ -76,6 +97,9 @@ class SQL(Magics, Configurable):
     conn_name = Unicode("", help="Object name for accessing computing resource environment").tag(config=True)
     output_result = Bool(DEFAULT_OUTPUT_RESULT, help="Output query result to stdout").tag(config=True)
     notify_result = Bool(DEFAULT_NOTIFY_RESULT, help="Notify query result to stdout").tag(config=True)
+    memory_budget = Float(0, help="Memory budget (MB) for query results; least recently used results\
+                                     are spilled to disk when exceeded. 0 disables").tag(config=True)
+    spill_dir = Unicode("", help="Directory for spilled query results (default: temporary directory)").tag(config=True)
 
     def __init__(self, shell):
         """Initialize sql_magic as a magic function; and add shell to configurables
@@ -85,7 +109,11 @@ class SQL(Magics, Configurable):
         self.shell.configurables.append(self)
         Configurable.__init__(self, config=shell.config)
         Magics.__init__(self, shell=shell)
-        self.conn = Connection(shell, available_connection_types, no_return_result_exceptions)
+        self.conn = Connection(shell, available_connection_types, no_return_result_exceptions,
+                               async_connection_types)
+        self.conn.memory.budget = int(self.memory_budget * 2 ** 20)
+        self.conn.memory.spill_dir = self.spill_dir
+        self.shell.events.register('pre_run_cell', self.conn.memory.pre_run_cell)
 
     @validate('conn_name')
     def _validate_conn_object(self, proposal):
@@ -98,6 +126,21 @@ class SQL(Magics, Configurable):
         new_conn_name = change['new']
         conn_object = self.shell.user_global_ns[new_conn_name]
         self.conn.caller = self.conn._read_connection(conn_object)
+        self.conn.async_caller = self.conn._read_connection_async(conn_object)
+
+    @observe('memory_budget')
+    def _assign_memory_budget(self, change):
+        """Set the memory budget (MB) and spill results if it's now exceeded."""
+        self.conn.memory.budget = int(change['new'] * 2 ** 20)
+        self.conn.memory.enforce_budget()
+
+    @observe('spill_dir')
+    def _assign_spill_dir(self, change):
+        self.conn.memory.spill_dir = change['new']
+
+    def _is_an_async_conn_name(self, conn_name):
+        """Check if the named connection object is an async driver object."""
+        return self.conn._is_an_async_connection(self.shell.user_global_ns.get(conn_name))
 
     @needs_local_scope
     @line_cell_magic
@@ -119,6 +162,13 @@ class SQL(Magics, Configurable):
 
         # line magic
         df = %read_sql SELECT * FROM TABLE
+
+        # run on the event loop (IPython autoawait); --await is implied for async connections
+        df = await %read_sql --await SELECT * FROM TABLE
+
+        %%read_sql df --await
+        SELECT *
+        FROM table
         """
         if cell:
             sql_code = cell
@@ -127,15 +177,26 @@ class SQL(Magics, Configurable):
             options['display'] = self.output_result ^ options['display']
             options['notify'] = self.notify_result ^ options['notify']
         else:
-            sql_code = line
+            sql_code, _await = utils.parse_read_sql_await(line)
             options = {'table_name': None,  # table assignment: df = %read_sql
                        'display': True,  # always return result
                        'notify': self.notify_result,
                        'force_caller': False,
-                       '_async': False}
+                       '_async': False,
+                       '_await': _await}
+        # async driver objects can only be used from the event loop, so --await is implicit
+        options['_await'] = options['_await'] or self._is_an_async_conn_name(options['force_caller']
+                                                                             or self.conn_name)
         sql = sql_code.format(**self.shell.user_global_ns)  # python variables {} in sql query
         statements = [s for s in sqlparse.split(sql) if not utils.is_empty_statement(s)]  # exclude blank statements
-        if options['_async']:
+        if options['_await'] and not cell:
+            return self.conn.execute_sqls_async(statements, options)  # awaited by the user
+        elif options['_await']:
+            # cell magics can't be awaited; run as a task on the kernel's event loop
+            result = self.conn.schedule_sqls_async(statements, options)
+            if options['display'] and not isinstance(result, asyncio.Task):
+                return result
+        elif options['_async']:
             options['display'] = False  #  must use browser notification to see when query completes
             t = threading.Thread(target=self.conn.execute_sqls, args=[statements, options])
             t.start()
@@ -144,6 +205,38 @@ class SQL(Magics, Configurable):
             if options['display']:
                 return result
 
+    @line_magic
+    def sql_memory(self, line):
+        """
+        Report and free memory used by query results bound with %%read_sql.
+
+        Example
+        ~~~~~~~
+        # show size, last access and status of each result
+        %sql_memory
+
+        # spill results to disk (all in-memory results if no names given)
+        %sql_memory free df1 df2
+
+        # reload spilled results into memory
+        %sql_memory load df1
+        """
+        args = line.split()
+        memory = self.conn.memory
+        if not args:
+            return memory.report()
+        command, names = args[0], args[1:]
+        if command == 'free':
+            names = names or list(memory.report().name)
+            for name in names:
+                memory.spill(name)
+        elif command == 'load':
+            for name in names:
+                memory.load(name)
+        else:
+            raise UsageError('Unknown %sql_memory command "{}"; use free or load'.format(command))
+        return memory.report()
+
 
 def load_ipython_extension(ip):
     """Load the extension in IPython."""
@@ -154,6 +247,16 @@ def load_ipython_extension(ip):
 def unload_ipython_extension(ip):
     """Reload the extension in IPython."""
     if 'SQL' in ip.magics_manager.registry:
+        sql_magic_obj = ip.magics_manager.registry['SQL']
+        if sql_magic_obj.conn.memory.pre_run_cell in ip.events.callbacks['pre_run_cell']:
+            ip.events.unregister('pre_run_cell', sql_magic_obj.conn.memory.pre_run_cell)
+        sql_magic_obj.conn.memory.close()
+        # drop every reference the shell keeps so the old instance can be freed
+        ip.configurables[:] = [c for c in ip.configurables if c is not sql_magic_obj]
+        for magic_type, magics in ip.magics_manager.magics.items():
+            for name, func in list(magics.items()):
+                if getattr(func, '__self__', None) is sql_magic_obj:
+                    del magics[name]
         del ip.magics_manager.registry['SQL']
     if 'SQL' in ip.config:
         del ip.config['SQL']
@@ -53,6 +53,8 @@ def create_flag_parser():
     ap.add_argument('-n', '--notify', help='Toggle option for notifying query result', action='store_true')
     ap.add_argument('-a', '--_async', help='Run query in seperate thread. Please be cautious when assigning\
                                            result to a variable', action='store_true')
+    ap.add_argument('-w', '--await', help='Run query on the event loop (IPython autoawait); the result is\
+                                           assigned once the query finishes', action='store_true', dest='_await')
     ap.add_argument('-d', '--display', help='Toggle option for outputing query result', action='store_true')
     ap.add_argument('-c', '--connection', help='Specify connection object for this query (override default\
                                                 connection object)', action='store', default=False)
@@ -64,7 +66,15 @@ def parse_read_sql_args(line_string):
     ap = create_flag_parser()
     opts = ap.parse_args(line_string.split())
     return {'table_name': opts.table_name, 'display': opts.display, 'notify': opts.notify,
-            '_async': opts._async, 'force_caller': opts.connection}
+            '_async': opts._async, '_await': opts._await, 'force_caller': opts.connection}
+
+
+def parse_read_sql_await(line_string):
+    """Strip a leading --await (or -w) flag from line magic SQL code."""
+    parts = line_string.split(None, 1)
+    if parts and parts[0] in ('-w', '--await'):
+        return (parts[1] if len(parts) > 1 else ''), True
+    return line_string, False
 
 
 def is_empty_statement(s):
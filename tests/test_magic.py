@@ -1,4 +1,6 @@
+import asyncio
 import ntpath
+import os
 import sys
 import time
 
@@ -7,6 +9,7 @@ import pytest
 
 import sql_magic
 from sql_magic.exceptions import EmptyResult
+from sql_magic.memory import MemoryGovernor, SpilledResult
 
 from IPython import get_ipython
 from sqlalchemy import create_engine
@@ -73,6 +76,111 @@ def test_query_1_async(conn):
     df = ip.user_global_ns['df']
     assert df.iloc[0, 0] == 'async_query'
 
+def test_line_magic_await(conn):
+    coro = ip.run_line_magic('read_sql', '--await SELECT 123')
+    df = asyncio.run(coro)
+    assert df.iloc[0, 0] == 123
+
+def test_query_1_await(conn):
+    # no event loop running, so the query runs to completion
+    ip.run_cell_magic('read_sql', 'df --await', 'SELECT 1')
+    df = ip.user_global_ns['df']
+    assert df.iloc[0, 0] == 1
+
+def test_sqlite3_connection_await():
+    ip.user_global_ns['sconn'] = sqlite.connect(':memory:')
+    sql_magic_obj = ip.magics_manager.registry['SQL']
+
+    async def run_queries():
+        for i in range(5):
+            ip.run_cell_magic('read_sql', 'df_{} -c sconn --await'.format(i), 'SELECT {}'.format(i))
+        await asyncio.gather(*list(sql_magic_obj.conn._tasks))
+    asyncio.run(run_queries())
+    for i in range(5):
+        assert ip.user_global_ns['df_{}'.format(i)].iloc[0, 0] == i
+
+def test_aiosqlite_concurrent_await():
+    aiosqlite = pytest.importorskip('aiosqlite')
+    sql_magic_obj = ip.magics_manager.registry['SQL']
+
+    async def run_queries():
+        async with aiosqlite.connect(':memory:') as aconn:
+            ip.user_global_ns['aconn'] = aconn
+            for i in range(20):
+                ip.run_cell_magic('read_sql', 'df_{} -c aconn'.format(i), 'SELECT {}'.format(i))
+            assert ip.user_global_ns['df_0'] == 'QUERY RUNNING'
+            await asyncio.gather(*list(sql_magic_obj.conn._tasks))
+    asyncio.run(run_queries())
+    for i in range(20):
+        assert ip.user_global_ns['df_{}'.format(i)].iloc[0, 0] == i
+
+class _FakeAsyncpgStatement(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get_attributes(self):
+        return [type('Attribute', (), {'name': 'x'})]
+
+    async def fetch(self):
+        if self.conn.busy:
+            raise RuntimeError('another operation is in progress')
+        self.conn.busy = True
+        await asyncio.sleep(0.01)
+        self.conn.busy = False
+        return [(1,)]
+
+
+class _FakeAsyncpgConnection(object):
+    busy = False
+
+    async def prepare(self, sql_code):
+        return _FakeAsyncpgStatement(self)
+
+
+def test_asyncpg_connection_queries_serialized():
+    sql_magic_obj = ip.magics_manager.registry['SQL']
+    caller = sql_magic_obj.conn._asyncpg_call(_FakeAsyncpgConnection())
+
+    async def run_queries():
+        return await asyncio.gather(*[caller('SELECT 1') for _ in range(10)])
+    for df in asyncio.run(run_queries()):
+        assert df.iloc[0, 0] == 1
+
+def test_aiosqlite_line_magic_implicit_await():
+    aiosqlite = pytest.importorskip('aiosqlite')
+    conn_name = ip.run_line_magic('config', 'SQL.conn_name')
+
+    async def run_queries():
+        async with aiosqlite.connect(':memory:') as aconn:
+            ip.user_global_ns['aconn'] = aconn
+            ip.run_line_magic('config', "SQL.conn_name = 'aconn'")
+            try:
+                df = await ip.run_line_magic('read_sql', 'SELECT 1')
+                assert df.iloc[0, 0] == 1
+                df = await ip.run_line_magic('read_sql', '--await SELECT 2')
+                assert df.iloc[0, 0] == 2
+            finally:
+                ip.run_line_magic('config', "SQL.conn_name = '{}'".format(conn_name))
+    asyncio.run(run_queries())
+
+def test_await_query_error_reported(conn):
+    sql_magic_obj = ip.magics_manager.registry['SQL']
+    reported = []
+    showtraceback = ip.showtraceback
+    ip.showtraceback = lambda exc_tuple=None, *args, **kwargs: reported.append(exc_tuple)
+
+    async def run_query():
+        ip.run_cell_magic('read_sql', 'df_bad --await', 'SELECT * FROM nosuchtable')
+        await asyncio.gather(*list(sql_magic_obj.conn._tasks), return_exceptions=True)
+        await asyncio.sleep(0)  # let the done callback run
+    try:
+        asyncio.run(run_query())
+    finally:
+        ip.showtraceback = showtraceback
+    assert len(reported) == 1
+    assert 'df_bad' not in ip.user_global_ns
+
 def test_query_1_notify(conn):
     ip.run_cell_magic('read_sql', 'df -n', 'SELECT 1')
     df = ip.user_global_ns['df']
@@ -115,3 +223,128 @@ def test_multiple_sql_statements_no_result(conn):
     ip.run_cell_magic('read_sql', '_df', 'DROP TABLE IF EXISTS test;')
     _df = ip.user_global_ns['_df']
     assert isinstance(_df, EmptyResult)
+
+@pytest.fixture
+def memory_budget():
+    pytest.importorskip('pyarrow')
+    ip.run_line_magic('config', 'SQL.memory_budget = 1e-6')  # ~1 byte; every result but the newest is spilled
+    yield ip.magics_manager.registry['SQL'].conn.memory
+    ip.run_line_magic('config', 'SQL.memory_budget = 0')
+
+def test_memory_budget_spill(conn, memory_budget):
+    ip.run_cell_magic('read_sql', 'df_a', 'SELECT 1')
+    ip.run_cell_magic('read_sql', 'df_b', 'SELECT 2')
+    assert isinstance(ip.user_global_ns['df_a'], SpilledResult)
+    assert ip.user_global_ns['df_a'].iloc[0, 0] == 1  # reloads df_a, spills df_b
+    assert isinstance(ip.user_global_ns['df_a'], pd.DataFrame)
+    assert isinstance(ip.user_global_ns['df_b'], SpilledResult)
+
+def test_spilled_alias_survives_rebind(conn, memory_budget):
+    ip.run_cell_magic('read_sql', 'df_a', 'SELECT 1')
+    ip.run_cell_magic('read_sql', 'df_b', 'SELECT 2')
+    x = ip.user_global_ns['df_a']
+    assert isinstance(x, SpilledResult)
+    ip.run_cell_magic('read_sql', 'df_a', 'SELECT 3')  # rebinds df_a
+    assert x.iloc[0, 0] == 1
+
+def test_spilled_alias_survives_respill(conn, memory_budget):
+    ip.run_cell_magic('read_sql', 'df_a', 'SELECT 1')
+    ip.run_cell_magic('read_sql', 'df_b', 'SELECT 2')
+    x = ip.user_global_ns['df_a']
+    paths = {x._path}
+    for i in range(200):  # spill files of the same name must not collide
+        ip.run_cell_magic('read_sql', 'df_a', 'SELECT 3')
+        ip.run_cell_magic('read_sql', 'df_b', 'SELECT 2')
+        assert ip.user_global_ns['df_a']._path not in paths
+    assert x.iloc[0, 0] == 1
+
+def test_spilled_alias_survives_del(conn, memory_budget):
+    ip.run_cell_magic('read_sql', 'df_a', 'SELECT 1')
+    ip.run_cell_magic('read_sql', 'df_b', 'SELECT 2')
+    x = ip.user_global_ns['df_a']
+    del ip.user_global_ns['df_a']
+    ip.run_cell_magic('read_sql', 'df_c', 'SELECT 3')  # prunes df_a
+    assert x.iloc[0, 0] == 1
+
+def test_spilled_proxy_in_container(conn, memory_budget):
+    ip.run_cell_magic('read_sql', 'df_a', 'SELECT 1')
+    ip.run_cell_magic('read_sql', 'df_b', 'SELECT 2')
+    held = [ip.user_global_ns['df_a']]
+    assert held[0].iloc[0, 0] == 1  # first access reloads
+    assert held[0].iloc[0, 0] == 1
+    assert pd.concat([held[0].load()]).iloc[0, 0] == 1
+
+def test_spilled_names_reloaded_before_cell(conn, memory_budget):
+    ip.run_cell_magic('read_sql', 'df_a', 'SELECT 1 AS x')
+    ip.run_cell_magic('read_sql', 'df_b', 'SELECT 2 AS x')
+    ip.run_cell_magic('read_sql', 'df_c', 'SELECT 3 AS x')
+    ip.run_cell('import pandas as pd; df_sum = df_a + df_b; a_is_df = isinstance(df_a, pd.DataFrame)')
+    assert ip.user_global_ns['a_is_df']
+    assert ip.user_global_ns['df_sum'].iloc[0, 0] == 3
+
+@pytest.fixture
+def spill_reads(monkeypatch):
+    """Record spill files read back (errors in pre_run_cell are only printed by IPython)."""
+    reads = []
+    read_spill_file = sql_magic.memory._read_spill_file
+
+    def record_read(path):
+        reads.append(path)
+        return read_spill_file(path)
+    monkeypatch.setattr(sql_magic.memory, '_read_spill_file', record_read)
+    return reads
+
+def test_del_spilled_does_not_reload(conn, memory_budget, spill_reads):
+    ip.run_cell_magic('read_sql', 'df_a', 'SELECT 1')
+    ip.run_cell_magic('read_sql', 'df_b', 'SELECT 2')
+    assert isinstance(ip.user_global_ns['df_a'], SpilledResult)
+    result = ip.run_cell('# df_a is no longer needed\ndel df_a')
+    assert result.success and not spill_reads
+    assert 'df_a' not in ip.user_global_ns
+
+def test_rebind_spilled_does_not_reload(conn, memory_budget, spill_reads):
+    ip.run_cell_magic('read_sql', 'df_a', 'SELECT 1')
+    ip.run_cell_magic('read_sql', 'df_b', 'SELECT 2')
+    assert isinstance(ip.user_global_ns['df_a'], SpilledResult)
+    result = ip.run_cell('%%read_sql df_a\nSELECT 3 -- replaces df_a')
+    assert result.success and not spill_reads
+    assert ip.user_global_ns['df_a'].iloc[0, 0] == 3
+
+def test_spilled_proxy_operators(conn, memory_budget):
+    ip.run_cell_magic('read_sql', 'df_a', 'SELECT 1')
+    ip.run_cell_magic('read_sql', 'df_b', 'SELECT 2')
+    x = ip.user_global_ns['df_a']
+    assert isinstance(x, SpilledResult)
+    assert (x + 1).iloc[0, 0] == 2
+    assert (1 - x).iloc[0, 0] == 0
+    assert (x == 1).iloc[0, 0]
+
+def test_reloaded_result_is_writable(conn, memory_budget):
+    ip.run_cell_magic('read_sql', 'df_a', 'SELECT 1 AS x')
+    ip.run_cell_magic('read_sql', 'df_b', 'SELECT 2 AS x')
+    df = ip.user_global_ns['df_a'].load()
+    df.iloc[0, 0] = 5
+    assert df.iloc[0, 0] == 5
+
+def test_spill_failure_does_not_fail_query(conn, memory_budget):
+    ip.run_cell_magic('read_sql', 'df_dup', 'SELECT 1 AS x, 2 AS x')  # Arrow can't write duplicate columns
+    ip.run_cell_magic('read_sql', 'df_b', 'SELECT 2')
+    assert isinstance(ip.user_global_ns['df_dup'], pd.DataFrame)
+    assert ip.user_global_ns['df_b'].iloc[0, 0] == 2
+
+def test_sql_memory_magic(conn):
+    pytest.importorskip('pyarrow')
+    ip.run_cell_magic('read_sql', 'df_c', 'SELECT 3')
+    report = ip.run_line_magic('sql_memory', '')
+    assert 'df_c' in report.name.values
+    ip.run_line_magic('sql_memory', 'free df_c')
+    assert isinstance(ip.user_global_ns['df_c'], SpilledResult)
+    ip.run_line_magic('sql_memory', 'load df_c')
+    df = ip.user_global_ns['df_c']
+    assert isinstance(df, pd.DataFrame) and df.iloc[0, 0] == 3
+
+def test_memory_governor_close():
+    memory = MemoryGovernor(ip)
+    spill_dir = memory._get_spill_dir()
+    memory.close()
+    assert not os.path.exists(spill_dir)